@@ -0,0 +1,231 @@
+# coding: utf-8
+
+# storage backends for the database builders
+# both backends produce the same table names and accept the same sql,
+# so queries written for the sqlite database keep working on duckdb
+
+from logging import getLogger
+from contextlib import contextmanager
+import os
+import time
+import sqlite3
+from glob import glob, escape
+import pandas as pd
+logger = getLogger(__name__)
+
+class SQLiteBackend:
+  name = "sqlite"
+
+  @contextmanager
+  def connect(self, dbfile):
+    conn = sqlite3.connect(dbfile)
+    try:
+      yield conn
+      conn.commit()
+    finally:
+      conn.close()
+
+  def list_tables(self, conn):
+    q = "SELECT name FROM sqlite_master WHERE type ='table' AND name NOT LIKE 'sqlite_%';"
+    return [row[0] for row in conn.execute(q).fetchall()]
+
+  def execute(self, conn, q, params=()):
+    logger.info("Running query:\n%s", q)
+    return conn.execute(q, params)
+
+  def read_sql(self, conn, q, params=()):
+    logger.info("Running query:\n%s", q)
+    return pd.read_sql(q, conn, params=list(params))
+
+  def insert_df(self, conn, tablename, df):
+    # append rows, creating the table if not exists
+    df.to_sql(tablename, conn, if_exists="append", index=False)
+
+  def create_index(self, conn, name, tablename, columns):
+    q = 'CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(name, tablename, ", ".join(columns))
+    self.execute(conn, q)
+
+  def replace_table(self, conn, src, dst):
+    # replace table dst by src in a single transaction
+    # with WAL mode, readers keep seeing the old table until commit and are never blocked
+    conn.execute("BEGIN")
+    try:
+      conn.execute('DROP TABLE IF EXISTS "{}"'.format(dst))
+      conn.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(src, dst))
+      conn.execute("COMMIT")
+    except Exception:
+      conn.execute("ROLLBACK")
+      raise
+    logger.info("Table '%s' has been replaced by '%s'", dst, src)
+
+  # build-and-swap of database files:
+  #   buildfile = backend.prepare_build(dbfile)
+  #   (create tables, derived tables and indices in buildfile)
+  #   backend.swap(buildfile, dbfile)
+  # each build is a new versioned file "<dbfile>.v<n>" and dbfile is a symbolic link to the live one,
+  # the link is replaced atomically, so readers never see a partial database
+  # a database file is never replaced under its WAL: sqlite and duckdb resolve the link when opening,
+  # so each version has its own -wal and -shm files
+  # connections opened before the swap keep reading the previous version
+  # and should be reopened to see the new one; older versions than KEEP_VERSIONS are deleted
+  _sidecars = ("-wal", "-shm", "-journal")
+  KEEP_VERSIONS = 2
+  CHECKPOINT_RETRIES = 5
+  CHECKPOINT_WAIT = 1.0  # seconds
+
+  def _versions(self, dbfile):
+    # existing versions of dbfile as sorted list of (number, path)
+    out = []
+    for f in glob(escape(dbfile) + ".v*"):
+      n = f[len(dbfile) + 2:]
+      if n.isdigit():
+        out.append((int(n), f))
+    return sorted(out)
+
+  def _remove(self, path):
+    for f in [path] + [path + s for s in self._sidecars]:
+      if os.path.isfile(f):
+        os.remove(f)
+        logger.debug("File '%s' has been deleted", f)
+
+  def prepare_build(self, dbfile):
+    # path of the new version to build, stale files of failed builds are removed
+    dirname = os.path.dirname(dbfile)
+    if dirname != "":
+      os.makedirs(dirname, exist_ok=True)
+    live = os.path.realpath(dbfile) if os.path.islink(dbfile) else None
+    versions = self._versions(dbfile)
+    live_n = max([n for n, f in versions if os.path.realpath(f) == live], default=0)
+    for n, f in versions:
+      if n > live_n:
+        self._remove(f)
+        logger.debug("Stale build '%s' has been deleted", f)
+    return "{}.v{}".format(dbfile, live_n + 1)
+
+  def enable_wal(self, dbfile):
+    with self.connect(dbfile) as conn:
+      mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    logger.debug("Journal mode of '%s': %s", dbfile, mode)
+
+  def checkpoint(self, dbfile):
+    # flush the WAL into the database file, raises RuntimeError if readers or writers
+    # keep it busy after retries, i.e. when frames would be left in the -wal file
+    wal = dbfile + "-wal"
+    for i in range(self.CHECKPOINT_RETRIES):
+      with self.connect(dbfile) as conn:
+        busy, log, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+      if busy == 0 and (not os.path.isfile(wal) or os.path.getsize(wal) == 0):
+        return
+      logger.info("WAL of '%s' is busy (%d of %d frames checkpointed), retrying", dbfile, checkpointed, log)
+      time.sleep(self.CHECKPOINT_WAIT)
+    raise RuntimeError("Could not checkpoint the WAL of '{}', close other connections and retry".format(dbfile))
+
+  def swap(self, buildfile, dbfile):
+    # the build is switched to WAL mode (persistent) and checkpointed,
+    # so no -wal file of the build is left behind
+    self.enable_wal(buildfile)
+    self.checkpoint(buildfile)
+    if os.path.isfile(dbfile) and not os.path.islink(dbfile):
+      # a single database file (made by an older version, or on a system without symbolic links)
+      # is replaced below, which is safe only when its WAL is empty
+      self.checkpoint(dbfile)
+    link = dbfile + ".link"
+    try:
+      if os.path.lexists(link):
+        os.remove(link)
+      os.symlink(os.path.basename(buildfile), link)
+    except OSError as e:
+      # e.g. no privilege to create symbolic links on Windows
+      logger.warning("Could not create a symbolic link, replacing '%s' itself: %s", dbfile, e)
+      os.replace(buildfile, dbfile)
+      logger.info("'%s' has been swapped into '%s'", buildfile, dbfile)
+      return
+    os.replace(link, dbfile)
+    logger.info("'%s' has been swapped into '%s'", buildfile, dbfile)
+    versions = self._versions(dbfile)
+    for n, f in versions[:-self.KEEP_VERSIONS]:
+      self._remove(f)
+      logger.info("Old version '%s' has been deleted", f)
+
+  def insert_csvs(self, conn, tablename, csvfiles):
+    for c in csvfiles:
+      self.insert_df(conn, tablename, pd.read_csv(c))
+      logger.info("Inserted CSV file '%s' -> table '%s'", c, tablename)
+
+class DuckDBBackend(SQLiteBackend):
+  # embedded columnar engine, much faster for scan-and-aggregate queries
+  # requires `duckdb` package
+  name = "duckdb"
+
+  def __init__(self):
+    try:
+      import duckdb
+    except ImportError as e:
+      logger.error("duckdb backend requires 'duckdb' package: %s", e)
+      raise ImportError("duckdb backend requires 'duckdb' package (pip install duckdb)") from e
+    self._duckdb = duckdb
+
+  @contextmanager
+  def connect(self, dbfile):
+    conn = self._duckdb.connect(dbfile)
+    try:
+      yield conn
+    finally:
+      conn.close()
+
+  def list_tables(self, conn):
+    q = "SELECT table_name FROM information_schema.tables WHERE table_schema = 'main' AND table_type = 'BASE TABLE'"
+    return [row[0] for row in conn.execute(q).fetchall()]
+
+  def read_sql(self, conn, q, params=()):
+    logger.info("Running query:\n%s", q)
+    return conn.execute(q, list(params)).df()
+
+  _sidecars = (".wal",)
+
+  def create_index(self, conn, name, tablename, columns):
+    # columnar scans do not need indices, and indexed tables cannot be renamed in duckdb
+    pass
+
+  def enable_wal(self, dbfile):
+    # duckdb always writes through its own write-ahead log
+    pass
+
+  def checkpoint(self, dbfile):
+    # fails if another process has the file open, since duckdb locks it
+    with self.connect(dbfile) as conn:
+      conn.execute("CHECKPOINT")
+    wal = dbfile + ".wal"
+    if os.path.isfile(wal) and os.path.getsize(wal) > 0:
+      raise RuntimeError("Could not checkpoint the WAL of '{}', close other connections and retry".format(dbfile))
+
+  def _insert_relation(self, conn, tablename, select):
+    if tablename.lower() in set(t.lower() for t in self.list_tables(conn)):
+      conn.execute('INSERT INTO "{}" BY NAME {}'.format(tablename, select))
+    else:
+      conn.execute('CREATE TABLE "{}" AS {}'.format(tablename, select))
+
+  def insert_df(self, conn, tablename, df):
+    conn.register("_insert_df", df)
+    try:
+      self._insert_relation(conn, tablename, "SELECT * FROM _insert_df")
+    finally:
+      conn.unregister("_insert_df")
+
+  def insert_csvs(self, conn, tablename, csvfiles):
+    # bulk ingest all files at once
+    if len(csvfiles) == 0:
+      return
+    files = ", ".join("'{}'".format(c.replace("'", "''")) for c in csvfiles)
+    self._insert_relation(conn, tablename, "SELECT * FROM read_csv([{}], union_by_name = true)".format(files))
+    logger.info("Inserted %d CSV files -> table '%s'", len(csvfiles), tablename)
+
+BACKENDS = {"sqlite": SQLiteBackend, "duckdb": DuckDBBackend}
+
+def get_backend(backend="sqlite"):
+  # backend name or backend object
+  if isinstance(backend, SQLiteBackend):
+    return backend
+  if backend not in BACKENDS:
+    raise ValueError("Unknown backend '{}', must be one of {}".format(backend, list(BACKENDS)))
+  return BACKENDS[backend]()
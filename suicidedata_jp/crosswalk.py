@@ -0,0 +1,179 @@
+# coding: utf-8
+
+# geography crosswalk between NPA and MHLW data, and the joined monthly table
+#
+# geo_crosswalk:  one row per area (prefectures and designated cities)
+#   geotype       'prefecture' or 'city'
+#   areacode      prefecture code (1-47), or 5-digit municipality code for cities
+#   name          area name as normalized by `mhlw_prompt.parse`
+#   prefcode      prefecture code
+#   npa_geocode   geocode in NPA tables (A5 for prefectures, A7 for cities), NULL if not available
+#   mhlw_geocode  geocode in MHLW prompt table, NULL if not available
+# monthly_joined: by time, area and sex (total, male, female)
+#   npa_n_suicide   from A5 (prefectures) or A7 (cities), i.e. date of death and place of residence
+#   mhlw_n_death    from the MHLW prompt table, summed over ages and causes
+#
+# e.g.
+#   refresh_joined_table("joined.db", "npa.db", "mhlw.db")
+#   refresh_joined_table("joined.db", "npa.db", "mhlw.db", times=["2020-03"])  # after loading a month
+
+from logging import getLogger
+import pandas as pd
+
+from .backend import get_backend
+from .npa_prompt.database import geocode_digits
+from .utils import time_condition
+logger = getLogger(__name__)
+
+PREFECTURES = [
+  "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県",
+  "茨城県", "栃木県", "群馬県", "埼玉県", "千葉県", "東京都", "神奈川県",
+  "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県", "岐阜県",
+  "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県",
+  "奈良県", "和歌山県", "鳥取県", "島根県", "岡山県", "広島県", "山口県",
+  "徳島県", "香川県", "愛媛県", "高知県", "福岡県", "佐賀県", "長崎県",
+  "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県"
+]
+# designated cities (and Tokyo special wards), name -> municipality code
+DESIGNATED_CITIES = {
+  "東京都区部": 13100, "札幌市": 1100, "仙台市": 4100, "さいたま市": 11100, "千葉市": 12100,
+  "横浜市": 14100, "川崎市": 14130, "相模原市": 14150, "新潟市": 15100, "静岡市": 22100,
+  "浜松市": 22130, "名古屋市": 23100, "京都市": 26100, "大阪市": 27100, "堺市": 27140,
+  "神戸市": 28100, "岡山市": 33100, "広島市": 34100, "北九州市": 40100, "福岡市": 40130,
+  "熊本市": 43100
+}
+_KEYS = ["time", "geotype", "areacode", "sex"]
+
+def _static_areas():
+  prefs = pd.DataFrame({"geotype": "prefecture", "areacode": range(1, 48), "name": PREFECTURES})
+  prefs["prefcode"] = prefs.areacode
+  cities = pd.DataFrame({"geotype": "city", "areacode": list(DESIGNATED_CITIES.values()),
+                         "name": list(DESIGNATED_CITIES.keys())})
+  cities["prefcode"] = cities.areacode // 1000
+  return pd.concat([prefs, cities], ignore_index=True)
+
+def _npa_areacode_expr(digits):
+  # 5-digit municipality code, dropping the check digit of 6-digit codes
+  return "CAST((geocode - geocode % 10) / 10 AS INTEGER)" if digits == 6 else "geocode"
+
+def _read(dbfile, q, backend):
+  with backend.connect(dbfile) as conn:
+    return backend.read_sql(conn, q)
+
+def _crosswalk(npa_dbfile, mhlw_dbfile, backend):
+  out = _static_areas()
+  codes = ", ".join(str(c) for c in DESIGNATED_CITIES.values())
+  npa_prefs = _read(npa_dbfile, "SELECT DISTINCT geocode FROM A5 WHERE geocode BETWEEN 1 AND 47", backend)
+  areacode = _npa_areacode_expr(geocode_digits(npa_dbfile, "A7", backend=backend))
+  npa_cities = _read(npa_dbfile, """
+    SELECT DISTINCT geocode, {0} AS areacode FROM A7 WHERE {0} IN ({1})
+    """.format(areacode, codes), backend)
+  npa = pd.concat([npa_prefs.assign(geotype="prefecture", areacode=npa_prefs.geocode),
+                   npa_cities.assign(geotype="city")], ignore_index=True)
+  npa = npa.rename(columns={"geocode": "npa_geocode"})
+  mhlw = _read(mhlw_dbfile, "SELECT DISTINCT geocode AS mhlw_geocode, geoname AS name FROM prompt", backend)
+  out = (out.merge(npa[["geotype", "areacode", "npa_geocode"]], on=["geotype", "areacode"], how="left")
+            .merge(mhlw.drop_duplicates("name"), on="name", how="left"))
+  unmatched = sorted(set(mhlw.name) - set(out.name))
+  if len(unmatched) > 0:
+    logger.info("MHLW areas not in the crosswalk: %s", unmatched)
+  return out
+
+def _write_crosswalk(dbfile, crosswalk, backend):
+  with backend.connect(dbfile) as conn:
+    backend.execute(conn, "DROP TABLE IF EXISTS geo_crosswalk")
+    backend.insert_df(conn, "geo_crosswalk", crosswalk)
+  logger.info("Created crosswalk table in '%s' (%d areas)", dbfile, len(crosswalk))
+
+def create_crosswalk_table(dbfile, npa_dbfile, mhlw_dbfile, backend="sqlite"):
+  backend = get_backend(backend)
+  out = _crosswalk(npa_dbfile, mhlw_dbfile, backend)
+  _write_crosswalk(dbfile, out, backend)
+  return out
+
+def _new_areas(stored, crosswalk):
+  # names of areas whose NPA or MHLW geocode is now found but not in the stored crosswalk
+  m = crosswalk.merge(stored, on=["geotype", "areacode"], how="left", suffixes=("", "_stored"))
+  new = pd.Series(False, index=m.index)
+  for col in ["npa_geocode", "mhlw_geocode"]:
+    a, b = pd.to_numeric(m[col]), pd.to_numeric(m[col + "_stored"])
+    new |= a.notna() & ~(a == b)
+  return m.name[new].tolist()
+
+def _npa_monthly(npa_dbfile, crosswalk, times, backend):
+  prefs = _read(npa_dbfile, """
+    SELECT time, geocode AS npa_geocode, sex, SUM(n_suicide) AS npa_n_suicide
+    FROM A5 WHERE tabulation = 'age' AND {} GROUP BY time, geocode, sex
+    """.format(time_condition(times)), backend)
+  cw = crosswalk[crosswalk.npa_geocode.notna()]
+  out = [prefs.merge(cw[cw.geotype == "prefecture"], on="npa_geocode")]
+  codes = [str(int(c)) for c in cw[cw.geotype == "city"].npa_geocode]
+  if len(codes) > 0:
+    cities = _read(npa_dbfile, """
+      SELECT time, geocode AS npa_geocode, sex, SUM(n_suicide) AS npa_n_suicide
+      FROM A7 WHERE tabulation = 'age' AND {} AND geocode IN ({}) GROUP BY time, geocode, sex
+      """.format(time_condition(times), ", ".join(codes)), backend)
+    out.append(cities.merge(cw[cw.geotype == "city"], on="npa_geocode"))
+  out = pd.concat(out, ignore_index=True)
+  return out[_KEYS + ["npa_n_suicide"]]
+
+def _mhlw_monthly(mhlw_dbfile, crosswalk, times, backend):
+  x = _read(mhlw_dbfile, """
+    SELECT time, geoname AS name, sex, SUM(n_death) AS mhlw_n_death
+    FROM prompt WHERE {} GROUP BY time, geoname, sex
+    """.format(time_condition(times)), backend)
+  total = x.groupby(["time", "name"], as_index=False).mhlw_n_death.sum(min_count=1).assign(sex="total")
+  x = pd.concat([x, total], ignore_index=True).merge(crosswalk, on="name")
+  return x[_KEYS + ["mhlw_n_death"]]
+
+def refresh_joined_table(dbfile, npa_dbfile, mhlw_dbfile, times=None, backend="sqlite"):
+  # (re)create the joined table "monthly_joined" in dbfile
+  # times: months known to be updated; by default all months are compared with the existing table
+  #        and only months with changed values are rewritten
+  # the crosswalk table is created at the first run, and rebuilt when NPA or MHLW geocodes
+  # not in it appear; all months are then compared since their rows may change
+  backend = get_backend(backend)
+  with backend.connect(dbfile) as conn:
+    existing = backend.list_tables(conn)
+  crosswalk = _crosswalk(npa_dbfile, mhlw_dbfile, backend)
+  if "geo_crosswalk" in existing:
+    with backend.connect(dbfile) as conn:
+      stored = backend.read_sql(conn, "SELECT * FROM geo_crosswalk")
+    new = _new_areas(stored, crosswalk)
+    if len(new) > 0:
+      logger.info("New geocodes found for %s, rebuilding the crosswalk", new)
+      _write_crosswalk(dbfile, crosswalk, backend)
+      times = None
+    else:
+      crosswalk = stored
+  else:
+    _write_crosswalk(dbfile, crosswalk, backend)
+  crosswalk = crosswalk[["geotype", "areacode", "name", "npa_geocode"]]
+
+  x = pd.merge(_npa_monthly(npa_dbfile, crosswalk, times, backend),
+               _mhlw_monthly(mhlw_dbfile, crosswalk, times, backend), on=_KEYS, how="outer")
+  x = x.merge(crosswalk[["geotype", "areacode", "name"]], on=["geotype", "areacode"])
+  x = x[_KEYS + ["name", "npa_n_suicide", "mhlw_n_death"]].sort_values(_KEYS, ignore_index=True)
+
+  months = sorted(x.time.unique())
+  if "monthly_joined" in existing:
+    with backend.connect(dbfile) as conn:
+      old = backend.read_sql(conn, "SELECT * FROM monthly_joined WHERE {}".format(time_condition(months)))
+    # rewrite months whose rows differ from the current table
+    m = x.merge(old[_KEYS + ["npa_n_suicide", "mhlw_n_death"]], on=_KEYS, how="outer",
+                suffixes=("", "_old"), indicator=True)
+    changed = (m._merge != "both")
+    for col in ["npa_n_suicide", "mhlw_n_death"]:
+      a, b = pd.to_numeric(m[col]), pd.to_numeric(m[col + "_old"])
+      changed |= ~((a == b) | (a.isna() & b.isna()))
+    months = sorted(m.time[changed].unique())
+    x = x[x.time.isin(months)]
+  logger.info("Updating %d months of 'monthly_joined' in '%s': %s", len(months), dbfile, months)
+  if len(months) == 0:
+    return months
+  with backend.connect(dbfile) as conn:
+    if "monthly_joined" in existing:
+      backend.execute(conn, "DELETE FROM monthly_joined WHERE {}".format(time_condition(months)))
+    backend.insert_df(conn, "monthly_joined", x)
+    backend.create_index(conn, "monthly_joined_index", "monthly_joined", ["time", "areacode", "sex"])
+  return months
@@ -1 +1,2 @@
-from .download import download_spreadsheets
\ No newline at end of file
+from .download import download_spreadsheets
+from .validate import check_parsed, validate_files
\ No newline at end of file
@@ -3,32 +3,36 @@
 from logging import getLogger
 from glob import glob
 import os
-import pandas as pd
-import sqlite3
-from tqdm import tqdm
+import uuid
+
+from ..backend import get_backend
 logger = getLogger(__name__)
 
 
-def insert_csvs_to_sqlite(dbfile, csvdir, tablename="prompt"):
-  os.makedirs(os.path.dirname(dbfile), exist_ok=True)
-  if os.path.isfile(dbfile):
-    q = 'DROP TABLE IF EXISTS "{}"'.format(tablename)
-    with sqlite3.connect(dbfile) as conn:
-      c = conn.cursor()
-      logger.info("Running query: %s", q)
-      c.execute(q)
-    logger.debug("Existing table '%s' in '%s' has been deleted", tablename, dbfile)
+def insert_csvs_to_sqlite(dbfile, csvdir, tablename="prompt", backend="sqlite"):
+  # the table is built as "<tablename>__build" next to the live table,
+  # then swapped in a single transaction so readers never see a missing or partial table
+  backend = get_backend(backend)
+  if os.path.dirname(dbfile) != "":
+    os.makedirs(os.path.dirname(dbfile), exist_ok=True)
+  buildtable = tablename + "__build"
+  backend.enable_wal(dbfile)
+  with backend.connect(dbfile) as conn:
+    backend.execute(conn, 'DROP TABLE IF EXISTS "{}"'.format(buildtable))
   csvfiles = glob(os.path.join(csvdir, "**", "*.csv"), recursive=True)
-  logger.info("Start creating table '%s' of '%s'", tablename, dbfile)
-  for c in tqdm(csvfiles):
-    x = pd.read_csv(c)
-    with sqlite3.connect(dbfile) as conn:
-      x.to_sql(tablename, conn, if_exists="append", index=False)
-    logger.info("Inserted CSV file '%s' -> table '%s' of '%s'", c, tablename, dbfile)
-  logger.info("Finish creating table '%s' of '%s'", tablename, dbfile)
+  logger.info("Start creating table '%s' of '%s'", buildtable, dbfile)
+  with backend.connect(dbfile) as conn:
+    backend.insert_csvs(conn, buildtable, csvfiles)
+    # index names stay with the table after renaming, so make it unique to this build
+    index = "{}_index_{}".format(tablename, uuid.uuid4().hex)
+    backend.create_index(conn, index, buildtable, ["time", "geocode"])
+  logger.info("Finish creating table '%s' of '%s'", buildtable, dbfile)
+  with backend.connect(dbfile) as conn:
+    backend.replace_table(conn, buildtable, tablename)
 
-def create_sqlite_database(dbfile, csvdir, tablename="prompt"):
-  logger.info("Start creating table '%s' in '%s'", tablename, dbfile)
-  insert_csvs_to_sqlite(dbfile, csvdir, tablename=tablename)
+def create_sqlite_database(dbfile, csvdir, tablename="prompt", backend="sqlite"):
+  # backend: "sqlite" or "duckdb", see `backend.py`
+  logger.info("Start creating table '%s' in '%s' (%s)", tablename, dbfile, backend)
+  insert_csvs_to_sqlite(dbfile, csvdir, tablename=tablename, backend=backend)
   logger.info("End creating table '%s' in '%s'", tablename, dbfile)
 
@@ -3,19 +3,18 @@
 from logging import getLogger
 import os
 import re
-from urllib.request import urlopen
 from urllib.parse import urljoin
 from bs4 import BeautifulSoup as bs
 from tqdm import tqdm
 
-from ..utils import urlretrieve
+from ..utils import urlretrieve, urlread
 logger = getLogger(__name__)
 
 ROOTURL = "https://www.e-stat.go.jp/stat-search/files?page=1&layout=datalist&toukei=00450011&tstat=000001028897&cycle=1&tclass1=000001053058&tclass2=000001053060&result_back=1&tclass3val=0"
 KEYWORDS = ("県", "死因", "性", "年齢")
 
 def _find_month_urls():
-  x = urlopen(ROOTURL).read()
+  x = urlread(ROOTURL)
   soup = bs(x, "html.parser")
   links = soup.find_all("a")
   links = [l for l in links if re.match(r"\d+月$", l.text.strip())]
@@ -28,7 +27,7 @@ def _find_month_urls():
 
 def _find_file_link(url):
   # find target file links
-  x = urlopen(url).read()
+  x = urlread(url)
   soup = bs(x, "html.parser")
   links = soup.find_all("a")
   def _filter(link):
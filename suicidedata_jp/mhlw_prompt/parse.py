@@ -9,6 +9,8 @@ import pandas as pd
 import re
 import jaconv
 from tqdm import tqdm
+
+from ..xlsx import read_xlsx, str_value
 logger = getLogger(__name__)
 
 
@@ -19,10 +21,10 @@ def _read_as_xls(srcpath):
     return x
 
 def _read_as_xlsx(srcpath):
-  with open(srcpath, "rb") as f:
-    x = pd.read_excel(f, engine="openpyxl", header=None)
-    logger.debug("'%s' could be read as .xlsx file", srcpath)
-    return x
+  # streamed into a string array, first sheet only as in `pd.read_excel`
+  _, x = read_xlsx(srcpath, convert=str_value, sheets=[0])[0]
+  logger.debug("'%s' could be read as .xlsx file", srcpath)
+  return x
 
 def _read_as_csv(srcpath):
   with open(srcpath, "r", encoding="cp932") as f:
@@ -47,13 +49,16 @@ def _read_file(srcpath):
   for reader in readers:
     try:
       x = reader(srcpath)
+      if isinstance(x, np.ndarray):
+        return x  # already an array of strings
       return x.fillna("").values.astype(str)
     except Exception as e:
       logger.info("Failed to read with '%s': %s", reader, e)
       errors.append(str(e))
   raise ValueError("Failed to read '{}' (not .xls, .xlsx nor .csv?): {}".format(srcpath, ";".join(errors)))
 
-def parse_to_df(srcpath):
+def parse_to_df(srcpath, keep_total=False):
+  # keep_total: keep "計" rows as sex "total" (used by consistency checks)
   x = _read_file(srcpath)
   def _find_year_month():
     for i, j  in itertools.product(range(5), range(5)):
@@ -201,13 +206,13 @@ def parse_to_df(srcpath):
       cause = _normalize_cause(cause)
       logger.debug("Row %d: Cause updated to '%s'", i, cause)
     # skip criteria
-    if sex not in ("男", "女"):
+    if sex not in (("男", "女", "計") if keep_total else ("男", "女")):
       continue
     if geo is None or geo.find("全国") >= 0:
       continue
     if cause is None or cause.find("自殺") < 0:
       continue
-    sex_eng = "male" if sex == "男" else "female"
+    sex_eng = "male" if sex == "男" else "female" if sex == "女" else "total"
     row = [time, geocode, geoname, sex_eng, cause] + x[i, datarows].tolist()
     out.append(row)
   out = pd.DataFrame(out, columns=header)
@@ -0,0 +1,43 @@
+# coding: utf-8
+
+# consistency checks for parsed data
+#  sex_total: male and female counts add up to the total ("計") where totals exist
+# checks run as grouped operations over a whole data frame,
+# so all files can be validated at once
+
+from logging import getLogger
+import os
+import pandas as pd
+from tqdm import tqdm
+
+from .parse import parse_to_df
+logger = getLogger(__name__)
+
+REPORT_COLUMNS = ["check", "file", "time", "geocode", "geoname", "cause", "age", "expected", "actual"]
+
+def check_parsed(df, tol=0.5):
+  # df: output of `parse.parse_to_df(keep_total=True)`, possibly concatenated
+  # with "file" column if available
+  # returns violations as a data frame
+  keys = [k for k in ["file", "time", "geocode", "geoname", "cause", "age"] if k in df.columns]
+  x = df.groupby(keys + ["sex"], sort=False, dropna=False).n_death.sum(min_count=1).unstack("sex")
+  x = x.reindex(columns=["male", "female", "total"])
+  x = x[x.notna().all(axis=1)]
+  x = x[(x.male + x.female - x.total).abs() > tol].reset_index()
+  out = x.assign(check="sex_total", expected=x.total, actual=x.male + x.female)
+  return out.reindex(columns=REPORT_COLUMNS).rename_axis(columns=None).reset_index(drop=True)
+
+def validate_files(srcfiles, tol=0.5):
+  out = []
+  for srcpath in tqdm(srcfiles):
+    x = parse_to_df(srcpath, keep_total=True)
+    out.append(x.assign(file=os.path.basename(srcpath)))
+  if len(out) == 0:
+    return pd.DataFrame(columns=REPORT_COLUMNS)
+  out = check_parsed(pd.concat(out, ignore_index=True), tol=tol)
+  if len(out) > 0:
+    logger.warning("%d consistency violations:\n%s", len(out),
+                   out.groupby(["check", "file", "geocode"], dropna=False).size().to_string())
+  else:
+    logger.info("No consistency violation in %d files", len(srcfiles))
+  return out
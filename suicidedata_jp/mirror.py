@@ -0,0 +1,88 @@
+# coding: utf-8
+
+from logging import getLogger
+import os
+import time
+import mimetypes
+import tempfile
+from threading import Thread
+from urllib.parse import unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .utils import set_mirror, mirror_relpath, _mirror
+logger = getLogger(__name__)
+
+def record_mirror(mirrordir, month_from=(1000, 1), month_to=(9999, 12), sources=("npa", "mhlw")):
+  # snapshot index pages and files of the sources into the mirror directory
+  # downloaded files are saved into a temporary directory and discarded,
+  # only the copies recorded in the mirror are kept
+  from .npa_prompt import download_zipfiles
+  from .mhlw_prompt import download_spreadsheets
+  downloaders = {"npa": download_zipfiles, "mhlw": download_spreadsheets}
+  base, record = _mirror["base"], _mirror["record"]
+  set_mirror(base=base, record=mirrordir)
+  try:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      for source in sources:
+        logger.info("Recording '%s' into '%s'", source, mirrordir)
+        downloaders[source](os.path.join(tmpdir, source), month_from=month_from, month_to=month_to)
+  finally:
+    set_mirror(base=base, record=record)
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+  # replays a mirror directory recorded by `record_mirror`
+  # request path is the relative path in the mirror, i.e. "/<host>/<path>"
+  mirrordir = "."
+  latency = 0.0     # seconds to wait before responding
+  bandwidth = None  # bytes per second, None for unlimited
+  chunksize = 64 * 1024
+
+  def _find_file(self):
+    u = urlsplit(self.path)
+    relpath = unquote(u.path).lstrip("/")
+    if u.query != "":  # original url passed as is
+      relpath = mirror_relpath("http://" + relpath + "?" + u.query)
+    parts = [p for p in relpath.split("/") if p not in ("", ".", "..")]
+    path = os.path.join(self.mirrordir, *parts)
+    return path if os.path.isfile(path) else None
+
+  def do_GET(self):
+    if self.latency > 0:
+      time.sleep(self.latency)
+    path = self._find_file()
+    if path is None:
+      self.send_error(404, "Not found in mirror")
+      return
+    ctype, _ = mimetypes.guess_type(path.split("@")[0])
+    self.send_response(200)
+    self.send_header("Content-Type", ctype or "application/octet-stream")
+    self.send_header("Content-Length", str(os.path.getsize(path)))
+    self.end_headers()
+    with open(path, "rb") as f:
+      while True:
+        chunk = f.read(self.chunksize)
+        if not chunk:
+          break
+        self.wfile.write(chunk)
+        if self.bandwidth is not None:
+          time.sleep(len(chunk) / self.bandwidth)
+
+  def log_message(self, format, *args):
+    logger.debug("%s - %s", self.address_string(), format % args)
+
+def serve_mirror(mirrordir, host="127.0.0.1", port=8000, latency=0.0, bandwidth=None, background=False):
+  # serve the mirror directory over http with the given latency and bandwidth
+  # use with `set_mirror(base="http://<host>:<port>/")`
+  # with background=True, returns the server running in a daemon thread (call `shutdown()` to stop)
+  handler = type("Handler", (MirrorRequestHandler,),
+                 {"mirrordir": os.path.abspath(mirrordir), "latency": latency, "bandwidth": bandwidth})
+  server = ThreadingHTTPServer((host, port), handler)
+  logger.info("Serving mirror '%s' at http://%s:%d/ (latency: %s, bandwidth: %s)",
+              mirrordir, host, server.server_port, latency, bandwidth)
+  if background:
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
@@ -1,3 +1,4 @@
 from .download import download_zipfiles
 from .parse import parse_book, parse_zipfile, parse_zipfiles
-from .database import create_sqlite_database, create_derived_tables
\ No newline at end of file
+from .database import create_sqlite_database, create_derived_tables, update_sqlite_database, create_rollup_tables, aggregate
+from .validate import check_parsed, validate_book, validate_zipfiles, validate_csvs
\ No newline at end of file
@@ -4,18 +4,28 @@ from logging import getLogger
 import os
 import itertools
 from glob import glob
-import sqlite3
 import pandas as pd
 from tqdm import tqdm
+
+from ..backend import get_backend
+from ..utils import time_condition
+from .validate import validate_csvs
 logger = getLogger(__name__)
 
-def _create_derived_tables_AB5to8(dbfile):
+def _create_derived_tables_AB5to8(dbfile, times=None, backend="sqlite"):
+  # with times given, only the rows of these months are recomputed
   drop_table_template = "DROP TABLE IF EXISTS {table}_{tabulation}"
   craete_query_template = """
     CREATE TABLE {table}_{tabulation} AS
     SELECT {common_cols}, category AS "{tabulation}", n_suicide
     FROM {table} WHERE tabulation = '{tabulation}'
   """
+  delete_query_template = "DELETE FROM {table}_{tabulation} WHERE {condition}"
+  insert_query_template = """
+    INSERT INTO {table}_{tabulation}
+    SELECT {common_cols}, category AS "{tabulation}", n_suicide
+    FROM {table} WHERE tabulation = '{tabulation}' AND {condition}
+  """
   def _get_common_cols(table):
     out = ["time", "geocode", "geoname", "geoname2", 
            "timedef", "locdef", "sex"]
@@ -24,23 +34,174 @@ def _create_derived_tables_AB5to8(dbfile):
   tables = ["".join(a) for a in itertools.product("AB", "5678")]
   tabulations = ["age", "housemate", "occupation", "place", "means",
                  "hour", "dayofweek", "reason", "pastattempt"]
+  backend = get_backend(backend)
+  with backend.connect(dbfile) as conn:
+    existing = backend.list_tables(conn)
   for table, tabulation in tqdm(itertools.product(tables, tabulations),
                                 total=len(tables) * len(tabulations)):
     common_cols = _get_common_cols(table)
-    q1 = drop_table_template.format(table=table, tabulation=tabulation)
-    q2 = craete_query_template.format(table=table, tabulation=tabulation, common_cols=common_cols)
-    with sqlite3.connect(dbfile) as conn:
-      c = conn.cursor()
-      logger.info("Running query: %s", q1)
-      c.execute(q1)
-      logger.info("Running query:\n%s", q2)
-      c.execute(q2)
+    if times is None or "{}_{}".format(table, tabulation) not in existing:
+      queries = [drop_table_template.format(table=table, tabulation=tabulation),
+                 craete_query_template.format(table=table, tabulation=tabulation, common_cols=common_cols)]
+    else:
+      condition = time_condition(times)
+      queries = [delete_query_template.format(table=table, tabulation=tabulation, condition=condition),
+                 insert_query_template.format(table=table, tabulation=tabulation,
+                                              common_cols=common_cols, condition=condition)]
+    with backend.connect(dbfile) as conn:
+      for q in queries:
+        backend.execute(conn, q)
+
+# rollup tables "{table}_rollup" hold n_suicide aggregated by
+#  grain:    'month', 'quarter' or 'year'
+#  period:   e.g. '2020-01', '2020-Q1', '2020'
+#  prefcode: prefecture code, 0 for the nation total
+#  sex, tabulation, category
+# for municipality tables (A7, A8, B7, B8) ward rows are excluded
+# since wards are already counted in their city's "（計）" row
+ROLLUP_GRAINS = ("month", "quarter", "year")
+ROLLUP_DIMS = ("prefcode", "sex", "tabulation", "category")
+_PERIOD_EXPRS = {
+   "month": "time"
+  ,"quarter": """substr(time, 1, 4) || '-' || CASE
+      WHEN substr(time, 6, 2) <= '03' THEN 'Q1' WHEN substr(time, 6, 2) <= '06' THEN 'Q2'
+      WHEN substr(time, 6, 2) <= '09' THEN 'Q3' ELSE 'Q4' END"""
+  ,"year": "substr(time, 1, 4)"
+}
+
+def geocode_digits(dbfile, table, backend="sqlite"):
+  # municipality codes are 5 digits, or 6 digits with the check digit;
+  # decided per table, since 6-digit codes of prefectures 01-09 are below 100000
+  backend = get_backend(backend)
+  with backend.connect(dbfile) as conn:
+    maxcode = backend.execute(conn, 'SELECT MAX(geocode) FROM "{}"'.format(table)).fetchone()[0]
+  return 6 if maxcode is not None and maxcode >= 100000 else 5
+
+def _prefcode_expr(digits):
+  divisor = 10000 if digits == 6 else 1000
+  return """CASE WHEN geolevel = 'prefecture' THEN geocode
+      ELSE CAST((geocode - geocode % {0}) / {0} AS INTEGER) END""".format(divisor)
+
+def _rollup_periods(times):
+  # periods of each grain affected by the given months ("YYYY-MM")
+  quarter = lambda t: "{}-Q{}".format(t[:4], (int(t[5:7]) - 1) // 3 + 1)
+  return {"month": sorted(set(times)),
+          "quarter": sorted(set(quarter(t) for t in times)),
+          "year": sorted(set(t[:4] for t in times))}
+
+def create_rollup_tables(dbfile, times=None, backend="sqlite"):
+  # with times given, only the periods containing these months are recomputed
+  delete_query_template = "DELETE FROM {table}_rollup WHERE grain = '{grain}' AND period IN ({periods})"
+  insert_query_template = """
+    INSERT INTO {table}_rollup
+    SELECT '{grain}' AS grain, period, {prefcode}, sex, tabulation, category,
+           SUM(n_suicide) AS n_suicide
+    FROM (SELECT {period} AS period, {prefcode_expr} AS prefcode, sex, tabulation, category, n_suicide
+          FROM {table} WHERE {condition}) AS t
+    WHERE {period_condition}
+    GROUP BY period, {group_prefcode}sex, tabulation, category
+  """
+  tables = ["".join(a) for a in itertools.product("AB", "5678")]
+  backend = get_backend(backend)
+  with backend.connect(dbfile) as conn:
+    existing = backend.list_tables(conn)
+  tables = [t for t in tables if t in existing]
+  periods = None if times is None else _rollup_periods(times)
+  for table in tqdm(tables):
+    municipality = table[1] in "78"
+    prefcode_expr = _prefcode_expr(geocode_digits(dbfile, table, backend=backend))
+    # ward rows have empty geoname (see `parse._parse_AB5to8_sheet`)
+    condition = "COALESCE(geoname, '') <> ''" if municipality else "1 = 1"
+    queries = []
+    # a missing rollup table is filled for all periods, not only for the given months
+    rebuild = times is None or "{}_rollup".format(table) not in existing
+    if rebuild:
+      queries.append('DROP TABLE IF EXISTS {}_rollup'.format(table))
+      queries.append("""
+        CREATE TABLE {}_rollup (
+          grain TEXT, period TEXT, prefcode INTEGER, sex TEXT, tabulation TEXT, category TEXT,
+          n_suicide REAL
+        )""".format(table))
+    for grain in ROLLUP_GRAINS:
+      if rebuild:
+        period_condition = "1 = 1"
+      else:
+        period_condition = "period IN ({})".format(", ".join("'{}'".format(p) for p in periods[grain]))
+        queries.append(delete_query_template.format(
+          table=table, grain=grain, periods=", ".join("'{}'".format(p) for p in periods[grain])))
+      # municipality tables have no nation total row, add one by summing up all prefectures
+      prefcodes = [("prefcode", "prefcode, "), ("0 AS prefcode", "")] if municipality else [("prefcode", "prefcode, ")]
+      for prefcode, group_prefcode in prefcodes:
+        queries.append(insert_query_template.format(
+          table=table, grain=grain, period=_PERIOD_EXPRS[grain], prefcode=prefcode, group_prefcode=group_prefcode,
+          prefcode_expr=prefcode_expr, condition=condition, period_condition=period_condition))
+    with backend.connect(dbfile) as conn:
+      for q in queries:
+        backend.execute(conn, q)
+      backend.create_index(conn, "{}_rollup_index".format(table), "{}_rollup".format(table),
+                           ["grain", "period", "prefcode"])
 
-def create_derived_tables(dbfile):
-  _create_derived_tables_AB5to8(dbfile)
+def aggregate(dbfile, table, grain="year", by=(), backend="sqlite", **filters):
+  # sum of n_suicide by period of the grain and the columns in `by`
+  # e.g. aggregate(dbfile, "A7", "year", by=["prefcode", "sex"], tabulation="age")
+  # the query runs on the rollup table when all columns are available there,
+  # otherwise on the base table
+  # unless prefcode is in `by` or filters, the nation total (prefcode 0) is taken,
+  # since prefecture rows would otherwise be summed together with the nation row
+  assert grain in ROLLUP_GRAINS, "grain must be one of {}".format(ROLLUP_GRAINS)
+  by = list(by)
+  if "prefcode" not in by and "prefcode" not in filters:
+    filters["prefcode"] = 0
+  cols = set(by) | set(filters)
+  backend = get_backend(backend)
+  with backend.connect(dbfile) as conn:
+    use_rollup = "{}_rollup".format(table) in backend.list_tables(conn) and cols.issubset(ROLLUP_DIMS)
+  if use_rollup:
+    source = "(SELECT * FROM {}_rollup WHERE grain = '{}') AS t".format(table, grain)
+  else:
+    # rows must be prepared in the same way as the rollup tables
+    prefcode_expr = _prefcode_expr(geocode_digits(dbfile, table, backend=backend))
+    template = "SELECT *, {} AS period, {{}} AS prefcode FROM {} WHERE {{}}".format(_PERIOD_EXPRS[grain], table)
+    if table[1] in "78":
+      condition = "COALESCE(geoname, '') <> ''"
+      source = " UNION ALL ".join([template.format(prefcode_expr, condition),
+                                   template.format("0", condition)])
+    else:
+      source = template.format(prefcode_expr, "1 = 1")
+    source = "({}) AS t".format(source)
+  where = " AND ".join(['"{}" = ?'.format(k) for k in filters]) or "1 = 1"
+  cols = ", ".join(["period"] + ['"{}"'.format(b) for b in by])
+  q = "SELECT {cols}, SUM(n_suicide) AS n_suicide FROM {source} WHERE {where} GROUP BY {cols} ORDER BY {cols}".format(
+    cols=cols, source=source, where=where)
+  logger.info("Aggregating from %s", "rollup" if use_rollup else "base table")
+  with backend.connect(dbfile) as conn:
+    return backend.read_sql(conn, q, params=list(filters.values()))
 
-def insert_csvs_to_sqlite(dbfile, csvdir):
-  os.makedirs(os.path.dirname(dbfile), exist_ok=True)
+def create_derived_tables(dbfile, times=None, backend="sqlite"):
+  _create_derived_tables_AB5to8(dbfile, times=times, backend=backend)
+  create_rollup_tables(dbfile, times=times, backend=backend)
+
+def _create_indices(dbfile, backend="sqlite"):
+  backend = get_backend(backend)
+  tables = ["".join(a) for a in itertools.product("AB", "5678")]
+  with backend.connect(dbfile) as conn:
+    existing = backend.list_tables(conn)
+    for table in tables:
+      if table not in existing:
+        continue
+      backend.create_index(conn, "{}_index".format(table), table, ["time", "geocode"])
+
+def insert_csvs_to_sqlite(dbfile, csvdir, backend="sqlite", swap=True):
+  # swap: build a side file and swap it into dbfile once done,
+  #       otherwise dbfile is deleted and rebuilt in place
+  backend = get_backend(backend)
+  if swap:
+    buildfile = backend.prepare_build(dbfile)
+    insert_csvs_to_sqlite(buildfile, csvdir, backend=backend, swap=False)
+    backend.swap(buildfile, dbfile)
+    return
+  if os.path.dirname(dbfile) != "":
+    os.makedirs(os.path.dirname(dbfile), exist_ok=True)
   if os.path.isfile(dbfile):
     os.remove(dbfile)
     logger.debug("Existing '%s' has been deleted", dbfile)
@@ -53,17 +214,61 @@ def insert_csvs_to_sqlite(dbfile, csvdir):
     csvs = glob(os.path.join(d, "**", "*.csv"), recursive=True)  # include sub-folder as well.
     csvs.sort()
     logger.info("Start creating table '%s' (%d CSV files)", tablename, len(csvs))
-    for c in tqdm(csvs):
-      x = pd.read_csv(c)
-      with sqlite3.connect(dbfile) as conn:
-        x.to_sql(tablename, conn, if_exists="append", index=False)
-      logger.info("Inserted CSV file '%s' -> table '%s'", c, tablename)
+    with backend.connect(dbfile) as conn:
+      backend.insert_csvs(conn, tablename, csvs)
     logger.info("Finish creating table '%s'", tablename)
   
-def create_sqlite_database(dbfile, csvdir):
-  logger.info("Start inserting csv files to '%s'", dbfile)
-  insert_csvs_to_sqlite(dbfile, csvdir)
-  logger.info("End inserting csv files to '%s'", dbfile)
-  logger.info("Start creating derived tables in '%s'", dbfile)
-  create_derived_tables(dbfile)
-  logger.info("End creating derived tables in '%s'", dbfile)
+def update_sqlite_database(dbfile, csvdir, times=None, backend="sqlite"):
+  # load months into an existing database, replacing the rows of these months
+  # times: months to load, e.g. ["2020-01"]; by default the months not yet in the database
+  # derived and rollup tables are recomputed for the loaded months only
+  dirs = glob(os.path.join(csvdir, "*"))
+  dirs = [d for d in dirs if os.path.isdir(d)]
+  dirs.sort()
+  backend = get_backend(backend)
+  backend.enable_wal(dbfile)  # readers are not blocked while updating
+  loaded = set()
+  for d in dirs:
+    tablename = os.path.basename(d)
+    csvs = glob(os.path.join(d, "**", "*.csv"), recursive=True)
+    csvs.sort()
+    with backend.connect(dbfile) as conn:
+      if tablename in backend.list_tables(conn):
+        q = 'SELECT DISTINCT time FROM "{}"'.format(tablename)
+        existing = set(row[0] for row in backend.execute(conn, q).fetchall())
+      else:
+        existing = set()
+    csvs = {os.path.splitext(os.path.basename(c))[0]: c for c in csvs}  # csv file is named by month
+    targets = [t for t in sorted(csvs) if (t in times if times is not None else t not in existing)]
+    logger.info("Updating table '%s' (%d months: %s)", tablename, len(targets), targets)
+    with backend.connect(dbfile) as conn:
+      for t in targets:
+        if t in existing:
+          backend.execute(conn, 'DELETE FROM "{}" WHERE time = ?'.format(tablename), (t,))
+      backend.insert_csvs(conn, tablename, [csvs[t] for t in targets])
+    loaded.update(targets)
+  if len(loaded) == 0:
+    logger.info("No months to update in '%s'", dbfile)
+    return []
+  logger.info("Start updating derived tables in '%s' for %s", dbfile, sorted(loaded))
+  create_derived_tables(dbfile, times=loaded, backend=backend)
+  logger.info("End updating derived tables in '%s'", dbfile)
+  return sorted(loaded)
+
+def create_sqlite_database(dbfile, csvdir, backend="sqlite", validate=False):
+  # backend: "sqlite" or "duckdb", see `backend.py`
+  # validate: run consistency checks on the csv files first, violations are logged
+  # the database is built in a side file and swapped into dbfile when complete,
+  # so readers of dbfile never see a missing or partial database
+  if validate:
+    validate_csvs(csvdir)
+  backend = get_backend(backend)
+  buildfile = backend.prepare_build(dbfile)
+  logger.info("Start inserting csv files to '%s' (%s)", buildfile, backend.name)
+  insert_csvs_to_sqlite(buildfile, csvdir, backend=backend, swap=False)
+  logger.info("End inserting csv files to '%s'", buildfile)
+  logger.info("Start creating derived tables in '%s'", buildfile)
+  create_derived_tables(buildfile, backend=backend)
+  _create_indices(buildfile, backend=backend)
+  logger.info("End creating derived tables in '%s'", buildfile)
+  backend.swap(buildfile, dbfile)
@@ -3,19 +3,18 @@
 from logging import getLogger
 import os
 import re
-from urllib.request import urlopen
 from urllib.parse import urljoin
 from shutil import copyfileobj
 from bs4 import BeautifulSoup as bs
 from tqdm import tqdm
 
-from ..utils import urlretrieve
+from ..utils import urlretrieve, urlread
 logger = getLogger(__name__)
 
 ROOTURL = "https://www.mhlw.go.jp/stf/seisakunitsuite/bunya/0000140901.html"
 
 def _find_year_urls():
-  x = urlopen(ROOTURL).read()
+  x = urlread(ROOTURL)
   soup = bs(x, "html.parser")
   urls = []
   for l in soup.find_all("a"):
@@ -30,7 +29,7 @@ def _find_year_urls():
   return urls
 
 def _find_monthzip_urls(year_url):
-  x = urlopen(year_url).read()
+  x = urlread(year_url)
   soup = bs(x, "html.parser")
   urls = {}
   for l in soup.find_all("a"):
@@ -5,13 +5,50 @@ import os
 import re
 import tempfile
 import itertools
+from collections import namedtuple
 from zipfile import ZipFile
 from shutil import rmtree, copyfileobj
 import pandas as pd
 from tqdm import tqdm
 from xlrd import open_workbook
+
+from ..xlsx import read_xlsx, xlrd_value
 logger = getLogger(__name__)
 
+# .xlsx workbooks are read into objects mimicking the part of xlrd's interface used here
+# (book.sheets(), sheet.name, sheet.nrows, sheet.ncols, sheet[i][j].value)
+_Cell = namedtuple("_Cell", ["value"])
+
+class _XlsxSheet:
+  def __init__(self, name, values):
+    self.name = name
+    self.nrows, self.ncols = values.shape
+    # rows are built once, the parsers index the same cells many times
+    self._rows = [[_Cell(v) for v in row] for row in values]
+
+  def __getitem__(self, i):
+    return self._rows[i]
+
+  def __repr__(self):
+    return "<Sheet '{}' ({} x {})>".format(self.name, self.nrows, self.ncols)
+
+class _XlsxBook:
+  def __init__(self, path):
+    self.path = path
+    self._sheets = [_XlsxSheet(name, values) for name, values in read_xlsx(path, convert=xlrd_value)]
+
+  def sheets(self):
+    return self._sheets
+
+  def __repr__(self):
+    return "<Book '{}'>".format(self.path)
+
+def open_book(path):
+  # open .xls file with xlrd, .xlsx file with the streaming reader
+  if os.path.splitext(path)[1].lower() == ".xlsx":
+    return _XlsxBook(path)
+  return open_workbook(path)
+
 def get_sheet_type(sheet):
   for cell in sheet[0]:
     v = cell.value.strip()
@@ -22,8 +59,11 @@ def get_sheet_type(sheet):
 
 # todo: parser for [AB][1-4]
 
-def _parse_AB5to8_sheet(sheet):
+TOTAL_TABULATION = "total"
+
+def _parse_AB5to8_sheet(sheet, keep_total=False):
   # parser for [AB][5-8]
+  # keep_total: keep the sheet's own total column as tabulation "total" (used for validation)
   type_ = get_sheet_type(sheet)
   assert re.match("[AB][5-8]$", type_) is not None, "Given: '{}'".format(type_)
 
@@ -111,7 +151,7 @@ def _parse_AB5to8_sheet(sheet):
   col_locs = _find_col_locations()
 
   common_cols = col_locs.pop("common")
-  col_locs.pop("aggregate")  # we don't use these columns
+  aggregate_cols = col_locs.pop("aggregate")  # we don't use these columns, except the total
 
   if geolevel == "municipality":  # add extra column for wards ("ku")
     comman_cols_name = ["geocode", "geoname", "geoname2"]
@@ -126,6 +166,15 @@ def _parse_AB5to8_sheet(sheet):
   #print(categories)
   ignored = set(["無職", "無職者"])  # shall be ignored, these are subtotals
 
+  def _find_total_col():
+    # total column among the aggregate columns, by its header or the first one
+    for j in aggregate_cols:
+      if re.search("総数|合計|自殺者数|^計$", str(categories[j] or "")) is not None:
+        return j
+    return aggregate_cols[0]
+  if keep_total:
+    col_locs = dict([(TOTAL_TABULATION, [_find_total_col()])] + list(col_locs.items()))
+
   # obtain common data
   common = [[sheet[i][j].value for j in common_cols] for i in rows]
   common = pd.DataFrame(common, columns=comman_cols_name)
@@ -192,16 +241,16 @@ def _parse_AB5to8_sheet(sheet):
   out.n_suicide = out.n_suicide.astype(float)
   return out
 
-def parse_sheet(sheet):
+def parse_sheet(sheet, keep_total=False):
   type_ = get_sheet_type(sheet)
   if re.match("[AB][5-8]$", type_) is not None:
-    return _parse_AB5to8_sheet(sheet)
+    return _parse_AB5to8_sheet(sheet, keep_total=keep_total)
   else:
     None  # no parser defined yet
 
 def parse_book(book, outdir):
   if type(book) == str:
-    book = open_workbook(book)
+    book = open_book(book)
   out = {}
   for sheet in book.sheets():
     try:
@@ -226,15 +275,15 @@ def parse_book(book, outdir):
   return outfiles
 
 def extract_xls_files(zippath, outdir):
+  # extract .xls and .xlsx files
   logger.info("Extracting xls files in '%s' into '%s", zippath, outdir)  
   assert os.path.isdir(outdir), "'{}' is not a directory".format(outdir)
   assert os.path.isfile(zippath), "'{}' is not a file".format(zippath)
   xlsfiles = []
   with ZipFile(zippath) as z:
     for member in z.infolist():
-      if not os.path.splitext(member.filename)[1].lower() == ".xls":
-        logger.debug("'%s' is skipped (not a .xls file)", member.filename)
-        # all files so far are .xls, may need to allow .xlsx in the future
+      if os.path.splitext(member.filename)[1].lower() not in (".xls", ".xlsx"):
+        logger.debug("'%s' is skipped (not a .xls nor .xlsx file)", member.filename)
         continue
       filename = member.filename.encode("cp437").decode("cp932")
       filename = os.path.join(outdir, filename)
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+# consistency checks for parsed [AB][5-8] data
+# checks run as grouped operations over a whole data frame,
+# so a month, or the whole archive at once, can be validated in one call
+#  tabulation_total: categories of each tabulation sum to the sheet's total column;
+#                    parsed csv files do not keep the total, so the age tabulation is the reference there
+#  ward_sum:         ward rows of a municipality table sum to the city's "（計）" row
+# cells with missing values ("***") are not checked
+
+from logging import getLogger
+import os
+import tempfile
+from glob import glob
+import pandas as pd
+from tqdm import tqdm
+
+from .parse import parse_sheet, extract_xls_files, open_book, TOTAL_TABULATION
+logger = getLogger(__name__)
+
+REFERENCE_TABULATION = "age"  # when the total column is not available
+MULTI_COUNT_TABULATIONS = ("reason",)  # up to four reasons are counted per person
+REPORT_COLUMNS = ["check", "file", "sheet", "time", "tablecode", "sex", "geocode", "geoname",
+                  "tabulation", "category", "expected", "actual"]
+
+def _row_keys(df):
+  # columns identifying a row of the sheet
+  keys = ["file", "sheet", "time", "tablecode", "sex", "geocode", "geoname", "geoname2"]
+  return [k for k in keys if k in df.columns]
+
+def _sum_with_nulls(df, keys):
+  # sum of n_suicide and number of missing values by keys
+  out = (df.assign(_null=df.n_suicide.isna())
+           .groupby(keys, sort=False, dropna=False)
+           .agg(total=("n_suicide", "sum"), nulls=("_null", "sum")))
+  return out
+
+def _check_tabulation_total(df, tol):
+  keys = _row_keys(df)
+  reference = TOTAL_TABULATION if (df.tabulation == TOTAL_TABULATION).any() else REFERENCE_TABULATION
+  x = df[~df.tabulation.isin(MULTI_COUNT_TABULATIONS)]
+  x = _sum_with_nulls(x, keys + ["tabulation"]).reset_index()
+  ref = x[x.tabulation == reference].drop(columns="tabulation")
+  x = x[x.tabulation != reference].merge(ref, on=keys, suffixes=("", "_ref"))
+  x = x[(x.nulls == 0) & (x.nulls_ref == 0) & ((x.total - x.total_ref).abs() > tol)]
+  return x.assign(check="tabulation_total", category="", expected=x.total_ref, actual=x.total)
+
+def _check_ward_sum(df, tol):
+  if "tablecode" in df.columns:
+    df = df[df.tablecode.astype(str).str.match(r"[AB][78]$")]
+  else:
+    df = df[df.geolevel == "municipality"]
+  if len(df) == 0:
+    return pd.DataFrame(columns=REPORT_COLUMNS)
+  geoname = df.geoname.fillna("").astype(str).str.strip()
+  geoname2 = df.geoname2.fillna("").astype(str).str.strip()
+  ward = (geoname == "")
+  city = ~ward & (geoname2 == "")  # "（計）" rows
+  # wards follow their city's row in the sheet, so forward fill gives the parent city
+  parent = df.geocode.where(~ward).ffill()
+  keys = [k for k in _row_keys(df) if k not in ("geocode", "geoname", "geoname2")] + ["tabulation", "category"]
+  wards = df[ward].assign(geocode=parent[ward]).dropna(subset=["geocode"])
+  wards = _sum_with_nulls(wards.astype({"geocode": df.geocode.dtype}), keys + ["geocode"])
+  cities = df[city].set_index(keys + ["geocode"])
+  x = cities.join(wards, how="inner").reset_index()
+  x = x[(x.nulls == 0) & x.n_suicide.notna() & ((x.total - x.n_suicide).abs() > tol)]
+  return x.assign(check="ward_sum", expected=x.n_suicide, actual=x.total)
+
+def check_parsed(df, tol=0.5):
+  # df: output of `parse.parse_sheet` (or parsed csv files), possibly concatenated
+  # with "file" and "sheet" columns if available
+  # returns violations as a data frame
+  out = pd.concat([_check_tabulation_total(df, tol), _check_ward_sum(df, tol)], ignore_index=True)
+  out = out.reindex(columns=REPORT_COLUMNS)
+  return out.reset_index(drop=True)
+
+def _report(out, source):
+  if len(out) > 0:
+    logger.warning("%d consistency violations in '%s':\n%s", len(out), source,
+                   out.groupby(["check", "file", "sheet"], dropna=False).size().to_string())
+  else:
+    logger.info("No consistency violation in '%s'", source)
+  return out
+
+def validate_book(book, tol=0.5):
+  filename = book
+  if type(book) == str:
+    book = open_book(book)
+  out = []
+  for sheet in book.sheets():
+    x = parse_sheet(sheet, keep_total=True)
+    if x is None:
+      continue
+    out.append(x.assign(file=os.path.basename(str(filename)), sheet=sheet.name))
+  if len(out) == 0:
+    return pd.DataFrame(columns=REPORT_COLUMNS)
+  return _report(check_parsed(pd.concat(out, ignore_index=True), tol=tol), filename)
+
+def validate_zipfiles(zippaths, tol=0.5):
+  out = []
+  for zippath in tqdm(zippaths):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      for f in extract_xls_files(zippath, outdir=tmpdir):
+        out.append(validate_book(f, tol=tol))
+  return pd.concat(out, ignore_index=True) if len(out) > 0 else pd.DataFrame(columns=REPORT_COLUMNS)
+
+def validate_csvs(csvdir, tol=0.5):
+  # validate parsed csv files, i.e. outputs of `parse.parse_zipfiles`
+  # sheet is reported as "<tablecode>/<sex>" since csv files do not keep sheet names
+  csvs = glob(os.path.join(csvdir, "**", "*.csv"), recursive=True)
+  csvs.sort()
+  if len(csvs) == 0:
+    return pd.DataFrame(columns=REPORT_COLUMNS)
+  x = pd.concat([pd.read_csv(c).assign(file=os.path.relpath(c, csvdir)) for c in tqdm(csvs)],
+                ignore_index=True)
+  x["sheet"] = x.tablecode.astype(str) + "/" + x.sex.astype(str)
+  return _report(check_parsed(x, tol=tol), csvdir)
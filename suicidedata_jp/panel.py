@@ -0,0 +1,180 @@
+# coding: utf-8
+
+# wide panel arrays (month x geocode x category) for time-series consumers
+#
+# a panel directory contains
+#   values.bin      float64 array in C order, shape (months, geocodes, categories)
+#   months.txt      axis labels, one per line
+#   geocodes.txt
+#   categories.txt
+#   meta.json       how the panel was made
+# month is the outer axis so new months are added by appending to values.bin,
+# and the array is memory-mapped so many processes can share it without copying
+# revised months (provisional data) are overwritten in place, so processes mapping the panel
+# see the new values without reopening it
+# the geocode axis is labeled by geocode, or by geoname for rows without a code
+# (e.g. 外国 and 不詳 in the MHLW table, which have no code prefix); codes come first in numeric order
+# rows without both have no place on the axis and are dropped (the count is logged)
+#
+# e.g.
+#   export_panel(dbfile, "panels/A5_age", "A5_age", category="age", value="n_suicide",
+#                where="sex = 'total'")
+#   p = load_panel("panels/A5_age")
+#   p.values[:, p.geocodes.index("13"), :]   # Tokyo, all months and ages
+#   p.values.transpose(1, 0, 2)              # geocode x month x category view
+
+from logging import getLogger
+from collections import namedtuple
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .backend import get_backend
+from .utils import time_condition
+logger = getLogger(__name__)
+
+Panel = namedtuple("Panel", ["values", "months", "geocodes", "categories"])
+DTYPE = "float64"
+REVISED_MONTHS = 12  # trailing months of the panel compared with the table on each update
+_AXES = ("months", "geocodes", "categories")
+
+def _read_labels(paneldir, axis):
+  with open(os.path.join(paneldir, "{}.txt".format(axis)), encoding="utf-8") as f:
+    return [line.rstrip("\n") for line in f]
+
+def _write_labels(paneldir, axis, labels, mode="w"):
+  with open(os.path.join(paneldir, "{}.txt".format(axis)), mode, encoding="utf-8") as f:
+    for label in labels:
+      f.write("{}\n".format(label))
+
+def load_panel(paneldir, mode="r"):
+  # memory-map a panel, shape is determined by the label files
+  labels = {axis: _read_labels(paneldir, axis) for axis in _AXES}
+  shape = tuple(len(labels[axis]) for axis in _AXES)
+  path = os.path.join(paneldir, "values.bin")
+  if shape[0] == 0:
+    values = np.empty(shape, dtype=DTYPE)
+  else:
+    values = np.memmap(path, dtype=DTYPE, mode=mode, shape=shape)
+  return Panel(values, labels["months"], labels["geocodes"], labels["categories"])
+
+def _query(dbfile, table, category, value, where, after, backend, times=()):
+  # rows of months after `after` (all if None) and of `times`
+  backend = get_backend(backend)
+  conditions = [where] if where is not None else []
+  if after is not None:
+    months = "time > '{}'".format(after)
+    if len(times) > 0:
+      months += " OR " + time_condition(times)
+    conditions.append(months)
+  # geoname is kept only for rows without a code, so renamed areas stay on one label
+  name = "CASE WHEN geocode IS NULL OR CAST(geocode AS TEXT) = '' THEN geoname END"
+  q = 'SELECT time, geocode, {name} AS geoname, {cats}, SUM("{value}") AS value FROM "{table}" WHERE {where} GROUP BY time, geocode, {name}, {cats}'.format(
+    name=name, cats=", ".join('"{}"'.format(c) for c in category), value=value, table=table,
+    where=" AND ".join("({})".format(c) for c in conditions) or "1 = 1")
+  with backend.connect(dbfile) as conn:
+    x = backend.read_sql(conn, q)
+  nocode = x.geocode.isna() | (x.geocode.astype(str) == "")
+  nulls = nocode & x.geoname.isna()
+  if nulls.any():
+    logger.warning("Dropped %d rows with neither geocode nor geoname from '%s'", nulls.sum(), table)
+    x, nocode = x[~nulls].copy(), nocode[~nulls]
+  codes = x.geocode[~nocode]
+  # integer codes read as float when NULLs are present, so they are cast back before labeling
+  if pd.api.types.is_numeric_dtype(codes) and (codes % 1 == 0).all():
+    codes = codes.astype("int64")
+  x["geocode"] = x.geoname.astype(object)
+  x.loc[~nocode, "geocode"] = codes.astype(str)
+  x["category"] = x[category].astype(str).agg("/".join, axis=1) if len(x) > 0 else ""
+  return x
+
+def _to_array(x, months, geocodes, categories):
+  out = np.full((len(months), len(geocodes), len(categories)), np.nan, dtype=DTYPE)
+  i = pd.Index(months).get_indexer(x.time)
+  j = pd.Index(geocodes).get_indexer(x.geocode)
+  k = pd.Index(categories).get_indexer(x.category)
+  out[i, j, k] = x.value.astype(DTYPE).values
+  return out
+
+def _sorted_geocodes(geocodes):
+  # numeric codes in numeric order, then other labels (codes or names) in text order
+  isnum = lambda g: g.lstrip("-").isdigit()
+  return sorted(set(geocodes), key=lambda g: (0, int(g), "") if isnum(g) else (1, 0, g))
+
+def export_panel(dbfile, paneldir, table, category, value="n_suicide", where=None,
+                 rebuild=False, times=None, backend="sqlite"):
+  # table:    long table with "time", "geocode" and "geoname" columns, e.g. "A5_age", "prompt"
+  # category: column(s) for the category axis, labels of multiple columns are joined by "/"
+  # value:    value column, summed within each cell
+  # where:    sql condition to select rows, e.g. "sex = 'total'"
+  # times:    months of the panel known to be revised, e.g. ["2020-03"];
+  #           by default the last REVISED_MONTHS months are compared with the table
+  # if the panel already exists with the same settings, months after the last one are appended
+  # and revised months are overwritten;
+  # a full rebuild is done when new months bring new geocodes or categories
+  category = [category] if isinstance(category, str) else list(category)
+  meta = {"table": table, "category": category, "value": value, "where": where, "dtype": DTYPE}
+  metapath = os.path.join(paneldir, "meta.json")
+  if not rebuild and os.path.isfile(metapath):
+    with open(metapath, encoding="utf-8") as f:
+      if json.load(f) == meta:
+        return _append_panel(dbfile, paneldir, meta, times, backend)
+    logger.info("Panel settings differ from '%s', rebuilding", metapath)
+
+  x = _query(dbfile, table, category, value, where, None, backend)
+  months = sorted(x.time.unique())
+  geocodes = _sorted_geocodes(x.geocode)
+  categories = sorted(x.category.unique())
+  os.makedirs(paneldir, exist_ok=True)
+  # labels are written after values, since readers take the shape from the labels
+  for axis in _AXES:
+    _write_labels(paneldir, axis, [])
+  # a new file is swapped in, so processes mapping the old one are not affected
+  path = os.path.join(paneldir, "values.bin")
+  _to_array(x, months, geocodes, categories).tofile(path + ".tmp")
+  os.replace(path + ".tmp", path)
+  _write_labels(paneldir, "geocodes", geocodes)
+  _write_labels(paneldir, "categories", categories)
+  _write_labels(paneldir, "months", months)
+  with open(metapath, "w", encoding="utf-8") as f:
+    json.dump(meta, f, ensure_ascii=False)
+  logger.info("Exported panel '%s' -> '%s' (shape: %s)", table, paneldir,
+              (len(months), len(geocodes), len(categories)))
+  return load_panel(paneldir)
+
+def _append_panel(dbfile, paneldir, meta, times, backend):
+  panel = load_panel(paneldir)
+  after = panel.months[-1] if len(panel.months) > 0 else None
+  if times is None:
+    revised = panel.months[-REVISED_MONTHS:]
+  else:
+    revised = sorted(t for t in set(times) if t in panel.months)
+  x = _query(dbfile, meta["table"], meta["category"], meta["value"], meta["where"], after, backend,
+             times=revised)
+  if not (set(x.geocode).issubset(panel.geocodes) and set(x.category).issubset(panel.categories)):
+    logger.info("New geocodes or categories found, rebuilding panel '%s'", paneldir)
+    return export_panel(dbfile, paneldir, meta["table"], meta["category"], meta["value"],
+                        meta["where"], rebuild=True, backend=backend)
+  # months missing from the table now are compared as well, and become empty
+  old = _to_array(x[x.time.isin(revised)], revised, panel.geocodes, panel.categories)
+  changed = [k for k, t in enumerate(revised)
+             if not np.array_equal(panel.values[panel.months.index(t)], old[k], equal_nan=True)]
+  if len(changed) > 0:
+    values = load_panel(paneldir, mode="r+").values
+    for k in changed:
+      values[panel.months.index(revised[k])] = old[k]
+    values.flush()
+    del values
+    logger.info("Rewrote %d revised months of panel '%s': %s", len(changed), paneldir,
+                [revised[k] for k in changed])
+  x = x[~x.time.isin(panel.months)]
+  if len(x) == 0:
+    logger.info("No new month for panel '%s'", paneldir)
+    return load_panel(paneldir)
+  months = sorted(x.time.unique())
+  with open(os.path.join(paneldir, "values.bin"), "ab") as f:
+    _to_array(x, months, panel.geocodes, panel.categories).tofile(f)
+  _write_labels(paneldir, "months", months, mode="a")
+  logger.info("Appended %d months to panel '%s': %s", len(months), paneldir, months)
+  return load_panel(paneldir)
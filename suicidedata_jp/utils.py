@@ -2,39 +2,211 @@
 
 from logging import getLogger
 import os
-import sqlite3
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
 from shutil import copyfileobj
 from urllib.request import urlopen
+from urllib.parse import urlsplit, quote
 from tqdm import tqdm
 import pandas as pd
+
+from .backend import get_backend
 logger = getLogger(__name__)
 
+# Mirror settings shared by the download modules.
+#  base:   where to fetch from instead of the original sites,
+#          either a local mirror directory or a url serving one (see `mirror.serve_mirror`)
+#  record: local mirror directory to snapshot every fetched page and file into
+_mirror = {
+  "base": os.environ.get("SUICIDEDATA_JP_MIRROR") or None,
+  "record": os.environ.get("SUICIDEDATA_JP_RECORD") or None
+}
+
+def set_mirror(base=None, record=None):
+  # configure mirror mode, call with no argument to fetch from the original sites again
+  _mirror["base"] = base
+  _mirror["record"] = record
+  logger.info("Mirror settings: %s", _mirror)
+
+def mirror_relpath(url):
+  # relative path of the url within a mirror directory, e.g.
+  # "https://www.mhlw.go.jp/a/b.html" -> "www.mhlw.go.jp/a/b.html"
+  # query strings are kept as part of the file name so e-stat pages do not collide
+  u = urlsplit(url)
+  path = u.path.lstrip("/")
+  if path == "" or path.endswith("/"):
+    path += "index.html"
+  if u.query != "":
+    path += "@" + quote(u.query, safe="=&")
+  return "/".join([u.netloc] + [p for p in path.split("/") if p not in ("", ".", "..")])
+
+def resolve_url(url):
+  # url to actually fetch, taking the mirror setting into account
+  base = _mirror["base"]
+  if base is None:
+    return url
+  relpath = mirror_relpath(url)
+  if urlsplit(base).scheme in ("http", "https"):
+    return base.rstrip("/") + "/" + quote(relpath, safe="/@=&")
+  return Path(os.path.abspath(os.path.join(base, relpath))).as_uri()
+
+def _record(url, data):
+  if _mirror["record"] is None:
+    return
+  savepath = os.path.join(_mirror["record"], *mirror_relpath(url).split("/"))
+  os.makedirs(os.path.dirname(savepath), exist_ok=True)
+  with open(savepath, "wb") as f:
+    f.write(data)
+  logger.debug("Recorded '%s' -> '%s'", url, savepath)
+
+def urlread(url):
+  x = urlopen(resolve_url(url)).read()
+  _record(url, x)
+  return x
+
 def urlretrieve(url, savepath):
   os.makedirs(os.path.dirname(savepath), exist_ok=True)
-  obj = urlopen(url)
+  obj = urlopen(resolve_url(url))
   with open(savepath, "wb") as f:
     copyfileobj(obj, f)
+  if _mirror["record"] is not None:
+    with open(savepath, "rb") as f:
+      _record(url, f.read())
 
-def sqlite_to_csvs(dbfile, outdir, skipped=[], compress=True):
+def sqlite_to_csvs(dbfile, outdir, skipped=[], compress=True, backend="sqlite"):
+  backend = get_backend(backend)
   os.makedirs(outdir, exist_ok=True)
-  q = "SELECT name FROM sqlite_master WHERE type ='table' AND name NOT LIKE 'sqlite_%';"
-  with sqlite3.connect(dbfile) as conn:
-    c = conn.cursor()
-    c.execute(q)
-    tables = [row[0] for row in c]
+  with backend.connect(dbfile) as conn:
+    tables = backend.list_tables(conn)
   logger.info("%d tables in '%s': %s", len(tables), dbfile, tables)
   skipped = set([s.lower() for s in skipped])
   tables = [t for t in tables if t.lower() not in skipped]
   outpath = []
   for t in tqdm(tables):
     logger.info("Exporting '%s'", t)
-    with sqlite3.connect(dbfile) as conn:
+    with backend.connect(dbfile) as conn:
       q = 'SELECT * FROM "{}"'.format(t)
-      logger.info("Running query: %s", q)
-      x = pd.read_sql(q, conn)
+      x = backend.read_sql(conn, q)
       ext = ".csv.gz" if compress else ".csv"
       savepath = os.path.join(outdir, "{}{}".format(t, ext))
       x.to_csv(savepath, index=False)
       logger.info("Table '%s' -> File '%s'", t, savepath)
       outpath.append(savepath)
-  return outpath
\ No newline at end of file
+  return outpath
+
+def time_condition(times):
+  # sql condition restricting to the given months, or no restriction if times is None
+  if times is None:
+    return "1 = 1"
+  return "time IN ({})".format(", ".join("'{}'".format(t) for t in sorted(times)))
+
+# value columns of the tables in this package, all other columns form the natural key
+VALUE_COLUMNS = ("n_suicide", "n_death", "npa_n_suicide", "mhlw_n_death")
+
+def diff_frames(old, new, keys, values, old_columns=()):
+  # rows inserted, updated and deleted from old to new, compared on keys
+  # returns (inserted, updated, deleted): inserted and updated with all columns of new,
+  # deleted with key columns only
+  # old_columns: columns of old only (e.g. row ids) to carry along to updated and deleted
+  # duplicated keys are told apart by their order of appearance
+  keys = list(keys)
+  old_columns = list(old_columns)
+  def _prepare(df):
+    df = df.reset_index(drop=True)
+    return df.assign(_dup=df.groupby(keys, sort=False, dropna=False).cumcount())
+  old, new = _prepare(old), _prepare(new)
+  m = new.merge(old[keys + ["_dup"] + list(values) + old_columns], on=keys + ["_dup"], how="outer",
+                suffixes=("", "__old"), indicator=True)
+  changed = pd.Series(False, index=m.index)
+  for col in values:
+    a, b = m[col], m[col + "__old"]
+    changed |= ~((a == b) | (a.isna() & b.isna()))
+  cols = [c for c in new.columns if c != "_dup"]
+  inserted = m.loc[m._merge == "left_only", cols]
+  updated = m.loc[(m._merge == "both") & changed, cols + old_columns]
+  deleted = m.loc[m._merge == "right_only", keys + old_columns]
+  return (inserted.reset_index(drop=True), updated.reset_index(drop=True),
+          deleted.reset_index(drop=True))
+
+def _table_digest(df):
+  # digest of the columns and rows of a table, independent of row order
+  h = hashlib.sha256(json.dumps(list(df.columns), ensure_ascii=False).encode("utf-8"))
+  h.update(pd.util.hash_pandas_object(df, index=False).sort_values().values.tobytes())
+  return h.hexdigest()
+
+def _release_id(digests):
+  # id of a release from the digests of its tables, same rows give the same id
+  h = hashlib.sha256()
+  for t in sorted(digests):
+    h.update("{}:{}\n".format(t, digests[t]).encode("utf-8"))
+  return h.hexdigest()
+
+def sqlite_to_delta_csvs(dbfile, prev_dbfile, outdir, skipped=[], compress=True, backend="sqlite"):
+  # export rows changed since the previous release prev_dbfile, per table
+  #   <table>.deleted.csv[.gz]   key columns of deleted rows
+  #   <table>.updated.csv[.gz]   new values of updated rows
+  #   <table>.inserted.csv[.gz]  inserted rows
+  #   manifest.json              release ids, keys, row counts, files and digests of the tables
+  # release ids are derived from the exported rows (tables not skipped), so consumers can store
+  # the "target" id of the last applied delta; a delta applies only on top of the release whose id
+  # equals "base" in the manifest, and deleted, updated then inserted of each table are applied
+  backend = get_backend(backend)
+  os.makedirs(outdir, exist_ok=True)
+  def _tables(path):
+    with backend.connect(path) as conn:
+      return backend.list_tables(conn)
+  skipped = set([s.lower() for s in skipped])
+  tables = [t for t in _tables(dbfile) if t.lower() not in skipped]
+  prev_tables = set(_tables(prev_dbfile)) if prev_dbfile is not None else set()
+  ext = ".csv.gz" if compress else ".csv"
+  manifest = {
+    "base": None,
+    "target": None,
+    "created": datetime.now().isoformat(timespec="seconds"),
+    "order": ["deleted", "updated", "inserted"],
+    "tables": {},
+    "dropped": sorted(t for t in prev_tables if t not in tables and t.lower() not in skipped)
+  }
+  base_digests, target_digests = {}, {}
+  for t in manifest["dropped"]:
+    with backend.connect(prev_dbfile) as conn:
+      base_digests[t] = _table_digest(backend.read_sql(conn, 'SELECT * FROM "{}"'.format(t)))
+  for t in tqdm(tables):
+    q = 'SELECT * FROM "{}"'.format(t)
+    with backend.connect(dbfile) as conn:
+      new = backend.read_sql(conn, q)
+    target_digests[t] = _table_digest(new)
+    if t in prev_tables:
+      with backend.connect(prev_dbfile) as conn:
+        old = backend.read_sql(conn, q)
+      base_digests[t] = _table_digest(old)
+    else:
+      old = new.iloc[:0]
+    values = [c for c in new.columns if c in VALUE_COLUMNS]
+    keys = [c for c in new.columns if c not in VALUE_COLUMNS]
+    if list(old.columns) != list(new.columns):
+      logger.info("Columns of '%s' have changed, all rows are replaced", t)
+      old = old.iloc[:0].reindex(columns=new.columns)
+      manifest["dropped"].append(t)
+    inserted, updated, deleted = diff_frames(old, new, keys, values)
+    changes = {"deleted": deleted, "updated": updated, "inserted": inserted}
+    info = {"keys": keys, "digest": target_digests[t], "files": {}}
+    for kind in manifest["order"]:
+      x = changes[kind]
+      info[kind] = len(x)
+      if len(x) == 0:
+        continue
+      savepath = os.path.join(outdir, "{}.{}{}".format(t, kind, ext))
+      x.to_csv(savepath, index=False)
+      info["files"][kind] = os.path.basename(savepath)
+    logger.info("Table '%s': %s", t, {kind: info[kind] for kind in manifest["order"]})
+    manifest["tables"][t] = info
+  manifest["base"] = _release_id(base_digests) if prev_dbfile is not None else None
+  manifest["target"] = _release_id(target_digests)
+  manifestpath = os.path.join(outdir, "manifest.json")
+  with open(manifestpath, "w", encoding="utf-8") as f:
+    json.dump(manifest, f, ensure_ascii=False, indent=2)
+  logger.info("Delta from '%s' to '%s' -> '%s'", prev_dbfile, dbfile, manifestpath)
+  return manifestpath
@@ -0,0 +1,139 @@
+# coding: utf-8
+
+# versioned store of provisional data (暫定値) and their revisions
+#
+# each vintage of a month is stored as a delta against the previous vintage:
+# a history table keeps one row per version of a data row, valid from the vintage
+# it first appeared in until the vintage it was revised or deleted in
+#   <source>__<table>   data columns + row_id, valid_from, valid_to (NULL while current)
+#   vintages            log of added vintages with the number of changed rows
+# so a month that is not revised costs nothing, and a revision costs only the changed rows
+#
+# e.g. monthly, after downloading with replace=True and parsing into csv files,
+#   add_npa_csvs("store.db", "npa/csv", vintage="2020-04-15")
+#   add_mhlw_csvs("store.db", "mhlw/csv", vintage="2020-04-15")
+# then
+#   as_of("store.db", "npa", "A5", "2020-03-31")         # data as downloaded by the date
+#   materialize("store.db", "npa", "npa.db")             # latest vintage, with derived tables
+
+from logging import getLogger
+from datetime import date, datetime
+from glob import glob
+import os
+import pandas as pd
+from tqdm import tqdm
+
+from .backend import get_backend
+from .utils import diff_frames, time_condition, VALUE_COLUMNS
+from .npa_prompt.database import create_derived_tables as _create_npa_derived_tables
+logger = getLogger(__name__)
+
+_META_COLUMNS = ["row_id", "valid_from", "valid_to"]
+
+def _history_table(source, tablename):
+  return "{}__{}".format(source, tablename)
+
+def add_vintage(storefile, source, tablename, df, vintage=None, backend="sqlite"):
+  # add a vintage of the months in df (must have "time" column) to the store
+  # vintage: date the data was obtained, "YYYY-MM-DD", today by default
+  # returns numbers of inserted, updated and deleted rows
+  backend = get_backend(backend)
+  vintage = vintage or date.today().isoformat()
+  history = _history_table(source, tablename)
+  times = sorted(df.time.unique())
+  with backend.connect(storefile) as conn:
+    existing = backend.list_tables(conn)
+    if history in existing:
+      current = backend.read_sql(conn, 'SELECT * FROM "{}" WHERE valid_to IS NULL AND {}'.format(
+        history, time_condition(times)))
+      latest = backend.execute(conn, 'SELECT MAX(valid_from) FROM "{}" WHERE {}'.format(
+        history, time_condition(times))).fetchone()[0]
+      last_id = backend.execute(conn, 'SELECT MAX(row_id) FROM "{}"'.format(history)).fetchone()[0]
+    else:
+      current, latest, last_id = df.iloc[:0], None, None
+  if latest is not None and latest > vintage:
+    raise ValueError("Vintage '{}' is older than the latest vintage '{}' of {} in '{}'".format(
+      vintage, latest, times, history))
+
+  keys = [c for c in df.columns if c not in VALUE_COLUMNS]
+  values = [c for c in df.columns if c in VALUE_COLUMNS]
+  current = current.reindex(columns=list(df.columns) + ["row_id"])
+  inserted, updated, deleted = diff_frames(current, df, keys, values, old_columns=["row_id"])
+  added = pd.concat([inserted, updated.drop(columns="row_id")], ignore_index=True)
+  closed = pd.concat([updated.row_id, deleted.row_id], ignore_index=True).astype(int).tolist()
+  start = (last_id or 0) + 1
+  added["row_id"] = range(start, start + len(added))
+  added["valid_from"] = vintage
+  added["valid_to"] = pd.Series(pd.NA, index=added.index, dtype="string")
+
+  with backend.connect(storefile) as conn:
+    for i in range(0, len(closed), 500):
+      ids = ", ".join(str(r) for r in closed[i:i + 500])
+      backend.execute(conn, 'UPDATE "{}" SET valid_to = ? WHERE row_id IN ({})'.format(history, ids), (vintage,))
+    if len(added) > 0 or history not in existing:
+      backend.insert_df(conn, history, added)
+    backend.create_index(conn, history + "_current", history, ["valid_to", "time"])
+    backend.create_index(conn, history + "_vintage", history, ["time", "valid_from"])
+    log = pd.DataFrame({"source": source, "tablename": tablename, "time": times, "vintage": vintage,
+                        "added": datetime.now().isoformat(timespec="seconds")})
+    counts = {"inserted": len(inserted), "updated": len(updated), "deleted": len(deleted)}
+    backend.insert_df(conn, "vintages", log.assign(**counts))
+  logger.info("Added vintage '%s' of %s to '%s': %s", vintage, times, history, counts)
+  return counts
+
+def add_npa_csvs(storefile, csvdir, vintage=None, backend="sqlite"):
+  # add parsed NPA csv files (outputs of `npa_prompt.parse_zipfiles`) as a vintage
+  for d in sorted(glob(os.path.join(csvdir, "*"))):
+    if not os.path.isdir(d):
+      continue
+    tablename = os.path.basename(d)
+    csvs = sorted(glob(os.path.join(d, "**", "*.csv"), recursive=True))
+    for c in tqdm(csvs):
+      add_vintage(storefile, "npa", tablename, pd.read_csv(c), vintage=vintage, backend=backend)
+
+def add_mhlw_csvs(storefile, csvdir, vintage=None, backend="sqlite"):
+  # add parsed MHLW csv files (outputs of `mhlw_prompt.parse.parse_files`) as a vintage
+  csvs = sorted(glob(os.path.join(csvdir, "**", "*.csv"), recursive=True))
+  for c in tqdm(csvs):
+    add_vintage(storefile, "mhlw", "prompt", pd.read_csv(c), vintage=vintage, backend=backend)
+
+def _as_of_condition(as_of):
+  if as_of is None:
+    return "valid_to IS NULL"
+  return "valid_from <= '{0}' AND (valid_to IS NULL OR valid_to > '{0}')".format(as_of)
+
+def as_of(storefile, source, tablename, as_of=None, times=None, backend="sqlite"):
+  # data of the table as of the date ("YYYY-MM-DD"), latest vintage if None
+  backend = get_backend(backend)
+  condition = _as_of_condition(as_of) + " AND " + time_condition(times)
+  with backend.connect(storefile) as conn:
+    x = backend.read_sql(conn, 'SELECT * FROM "{}" WHERE {} ORDER BY row_id'.format(
+      _history_table(source, tablename), condition))
+  return x.drop(columns=_META_COLUMNS)
+
+def list_vintages(storefile, source=None, backend="sqlite"):
+  backend = get_backend(backend)
+  condition = "1 = 1" if source is None else "source = '{}'".format(source)
+  with backend.connect(storefile) as conn:
+    return backend.read_sql(conn, "SELECT * FROM vintages WHERE {} ORDER BY vintage, source, tablename, time".format(condition))
+
+def materialize(storefile, source, dbfile, as_of=None, backend="sqlite"):
+  # write the tables of the source as of the date (latest if None) into dbfile
+  # with the original table names; for NPA, derived tables are created as well
+  # dbfile is built in a side file and swapped in when complete
+  backend = get_backend(backend)
+  prefix = _history_table(source, "")
+  with backend.connect(storefile) as conn:
+    tables = [t for t in backend.list_tables(conn) if t.startswith(prefix)]
+  buildfile = backend.prepare_build(dbfile)
+  for history in tables:
+    tablename = history[len(prefix):]
+    q = 'SELECT * FROM "{}" WHERE {} ORDER BY row_id'.format(history, _as_of_condition(as_of))
+    with backend.connect(storefile) as conn:
+      x = backend.read_sql(conn, q).drop(columns=_META_COLUMNS)
+    with backend.connect(buildfile) as conn:
+      backend.insert_df(conn, tablename, x)
+    logger.info("Materialized '%s' (as of %s) -> table '%s' (%d rows)", history, as_of or "latest", tablename, len(x))
+  if source == "npa":
+    _create_npa_derived_tables(buildfile, backend=backend)
+  backend.swap(buildfile, dbfile)
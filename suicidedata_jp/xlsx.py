@@ -0,0 +1,76 @@
+# coding: utf-8
+
+# streaming reader for .xlsx files
+# rows are streamed through openpyxl's read-only iterator into a preallocated array,
+# so the workbook is never held as a whole in memory nor copied into a data frame
+
+from logging import getLogger
+import numpy as np
+from openpyxl import load_workbook
+logger = getLogger(__name__)
+
+MAX_PREALLOCATED_COLS = 256        # sheet dimensions may be stale, do not trust huge values
+MAX_PREALLOCATED_CELLS = 1 << 20   # 8 MiB of object pointers, the array grows if needed
+MAX_BLANK_ROWS = 1000              # stop after this many consecutive blank rows
+
+def str_value(v):
+  # cell value as text, numbers without trailing ".0" when integral
+  if v is None:
+    return ""
+  if isinstance(v, float) and v.is_integer():
+    return str(int(v))
+  return str(v)
+
+def xlrd_value(v):
+  # cell value as xlrd gives: empty as "", numbers as float
+  if v is None:
+    return ""
+  if isinstance(v, (int, float)):
+    return float(v)
+  return v if isinstance(v, str) else str(v)
+
+def read_sheet(ws, convert=str_value, max_blank_rows=MAX_BLANK_ROWS):
+  # read a read-only worksheet into an object array of converted values
+  # trailing blank rows are dropped
+  # the dimension is used only to preallocate, then reset: otherwise every row is padded
+  # to the stated width, while without it rows end at their last cell and reading ends
+  # at the last row stored in the sheet
+  width = ws.max_column or 1
+  ncols = min(width, MAX_PREALLOCATED_COLS)
+  nrows = min(ws.max_row or 1024, MAX_PREALLOCATED_CELLS // ncols)
+  if width > MAX_PREALLOCATED_COLS:
+    width = 0  # stale, trim to the last non-blank column instead
+  ws.reset_dimensions()
+  empty = convert(None)
+  out = np.full((nrows, ncols), empty, dtype=object)
+  lastrow, lastcol, blanks = -1, -1, 0
+  for i, row in enumerate(ws.iter_rows(values_only=True)):
+    if i >= out.shape[0] or len(row) > out.shape[1]:
+      grown = np.full((max(out.shape[0] * 2, i + 1), max(out.shape[1], len(row))), empty, dtype=object)
+      grown[:out.shape[0], :out.shape[1]] = out
+      out = grown
+    blank = True
+    for j, v in enumerate(row):
+      if v is not None:
+        out[i, j] = convert(v)
+        lastcol = max(lastcol, j)
+        blank = False
+    if blank:
+      blanks += 1
+      if max_blank_rows is not None and blanks >= max_blank_rows:
+        logger.debug("Stopped reading '%s' after %d blank rows", ws.title, blanks)
+        break
+    else:
+      lastrow, blanks = i, 0
+  return out[:lastrow + 1, :max(width, lastcol + 1)]
+
+def read_xlsx(path, convert=str_value, max_blank_rows=MAX_BLANK_ROWS, sheets=None):
+  # returns list of (sheet name, array)
+  # sheets: indices of sheets to read, all sheets by default
+  wb = load_workbook(path, read_only=True, data_only=True)
+  try:
+    worksheets = wb.worksheets if sheets is None else [wb.worksheets[i] for i in sheets]
+    return [(ws.title, read_sheet(ws, convert=convert, max_blank_rows=max_blank_rows))
+            for ws in worksheets]
+  finally:
+    wb.close()